@@ -1,29 +1,83 @@
-import time
+from time import perf_counter as _pc
 import logging
 import requests
 import threading
 from datetime import datetime
-from typing import Dict, Optional, List
+from typing import Deque, Dict, Optional, List
+from collections import Counter, deque
 import json
 import os
 from pathlib import Path
 from pybit.unified_trading import HTTP
 from dotenv import load_dotenv
 
+class _SlotItemAccess:
+    """Accès par clé aux champs déclarés dans __slots__, comme pour un dictionnaire"""
+    __slots__ = ()
+
+    def __getitem__(self, key: str):
+        """Renvoie le champ demandé, KeyError pour tout nom absent de __slots__"""
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+class Metric(_SlotItemAccess):
+    """Métrique d'API, stockée sans dictionnaire par instance"""
+    __slots__ = ('timestamp', 'type', 'value', 'endpoint', 'testnet', 'exchange')
+
+    def __init__(self, timestamp: str, type: str, value: float, endpoint: str, testnet: bool, exchange: str):
+        self.timestamp = timestamp
+        self.type = type
+        self.value = value
+        self.endpoint = endpoint
+        self.testnet = testnet
+        self.exchange = exchange
+
+    def to_dict(self) -> Dict:
+        """Convertit la métrique en dictionnaire sérialisable"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def to_json(self) -> str:
+        """Sérialise la métrique en objet JSON, sans dictionnaire intermédiaire"""
+        return _METRIC_JSON_TEMPLATE.format(*(_json_encode(getattr(self, name)) for name in self.__slots__))
+
+# Gabarit JSON d'une métrique, mêmes clés et séparateurs que json.dump
+_METRIC_JSON_TEMPLATE = "{{" + ", ".join(f'"{name}": {{}}' for name in Metric.__slots__) + "}}"
+_json_encode = json.JSONEncoder().encode
+
+class AlertThresholds(_SlotItemAccess):
+    """Seuils d'alerte, lus par attribut et modifiables comme un dictionnaire"""
+    __slots__ = ('latency', 'error_rate', 'consecutive_failures', 'rate_limit_threshold')
+
+    def __init__(self, latency: float = 2000, error_rate: float = 0.1,
+                 consecutive_failures: int = 3, rate_limit_threshold: float = 0.8):
+        self.latency = latency  # ms - aligné avec Binance
+        self.error_rate = error_rate  # 10%
+        self.consecutive_failures = consecutive_failures
+        self.rate_limit_threshold = rate_limit_threshold  # 80% de la limite d'utilisation
+
+    def __setitem__(self, key: str, value: float):
+        """Modification par clé, limitée aux seuils connus"""
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
 class APIMonitor:
-    def __init__(self, log_dir: str = "logs", testnet: bool = False):
+    def __init__(self, log_dir: str = "logs", testnet: bool = False, max_metrics: int = 10_000):
+        if max_metrics < 1:
+            raise ValueError(f"max_metrics must be at least 1, got {max_metrics}")
+        
         # Créer le répertoire de logs s'il n'existe pas
         self.log_dir = os.path.abspath(log_dir)
         Path(self.log_dir).mkdir(parents=True, exist_ok=True)
         
         self._setup_logging()
-        self.metrics: List[Dict] = []
-        self.alert_thresholds = {
-            'latency': 2000,  # ms - aligné avec Binance
-            'error_rate': 0.1,  # 10%
-            'consecutive_failures': 3,
-            'rate_limit_threshold': 0.8  # 80% de la limite d'utilisation
-        }
+        # Fenêtre glissante : les métriques les plus anciennes sont évincées
+        self.metrics: Deque[Metric] = deque(maxlen=max_metrics)
+        # Protège la fenêtre et ses agrégats : run() enregistre depuis son propre thread
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+        self.alert_thresholds = AlertThresholds()
         self.consecutive_failures = 0
         self.testnet = testnet
         self.exchange = "bybit"
@@ -55,6 +109,49 @@ class APIMonitor:
 
         self.base_url = "https://api.bybit.com"
 
+    def _reset_stats(self):
+        """Réinitialise les agrégats et compteurs de la fenêtre de métriques"""
+        # Numéro de séquence de la prochaine métrique enregistrée
+        self._next_seq = 0
+        self._latency_sum = 0.0
+        self._latency_count = 0
+        # Files monotones de (séquence, latence) : minimum et maximum de la fenêtre en tête
+        self._latency_mins: Deque = deque()
+        self._latency_maxs: Deque = deque()
+        # Nombre de métriques conservées par type
+        self.metric_counts: Counter = Counter()
+
+    def _add_to_stats(self, metric: Metric, seq: int):
+        """Ajoute une métrique entrant dans la fenêtre aux agrégats"""
+        self.metric_counts[metric.type] += 1
+        if metric.type == 'latency':
+            self._latency_sum += metric.value
+            self._latency_count += 1
+            while self._latency_mins and self._latency_mins[-1][1] >= metric.value:
+                self._latency_mins.pop()
+            self._latency_mins.append((seq, metric.value))
+            while self._latency_maxs and self._latency_maxs[-1][1] <= metric.value:
+                self._latency_maxs.pop()
+            self._latency_maxs.append((seq, metric.value))
+
+    def _remove_from_stats(self, metric: Metric, seq: int):
+        """Retire des agrégats une métrique évincée de la fenêtre"""
+        self.metric_counts[metric.type] -= 1
+        if metric.type == 'latency':
+            self._latency_count -= 1
+            # Remise à zéro explicite : pas d'erreur d'arrondi résiduelle sur une fenêtre vide
+            self._latency_sum = self._latency_sum - metric.value if self._latency_count else 0.0
+            if self._latency_mins and self._latency_mins[0][0] == seq:
+                self._latency_mins.popleft()
+            if self._latency_maxs and self._latency_maxs[0][0] == seq:
+                self._latency_maxs.popleft()
+
+    def reset_metrics(self):
+        """Efface les métriques enregistrées, les statistiques de latence et les compteurs"""
+        with self._stats_lock:
+            self.metrics.clear()
+            self._reset_stats()
+
     def _setup_logging(self):
         """Configure le système de logging"""
         self.logger = logging.getLogger('bybit_api_monitor')
@@ -85,7 +182,8 @@ class APIMonitor:
     def measure_latency(self, endpoint: str, method: str = "GET", **kwargs) -> Optional[float]:
         """Mesure la latence d'un appel API Bybit"""
         try:
-            start_time = time.time()
+            # Horloge monotone : insensible aux ajustements de l'heure système
+            start_time = _pc()
             
             if not self.client:
                 response = requests.get(f"{self.base_url}{endpoint}")
@@ -101,7 +199,7 @@ class APIMonitor:
                 
                 response = method_map[method](**kwargs)
             
-            end_time = time.time()
+            end_time = _pc()
             latency = (end_time - start_time) * 1000  # Convertir en millisecondes
             
             if self.is_valid_response(response):
@@ -166,7 +264,7 @@ class APIMonitor:
                 'weight': current_usage,
                 'limit': rate_limit,
                 'usage_percent': usage_percent,
-                'status': 'CRITICAL' if usage_percent > self.alert_thresholds['rate_limit_threshold'] * 100 else 'OK'
+                'status': 'CRITICAL' if usage_percent > self.alert_thresholds.rate_limit_threshold * 100 else 'OK'
             }
             
             self.record_metric('rate_limit', usage_percent, 'rate_limits')
@@ -183,74 +281,99 @@ class APIMonitor:
 
     def record_metric(self, metric_type: str, value: float, endpoint: str):
         """Enregistre une métrique"""
-        metric = {
-            'timestamp': datetime.now().isoformat(),
-            'type': metric_type,
-            'value': value,
-            'endpoint': endpoint,
-            'testnet': self.testnet,
-            'exchange': self.exchange
-        }
-        self.metrics.append(metric)
+        metric = Metric(
+            timestamp=datetime.now().isoformat(),
+            type=metric_type,
+            value=value,
+            endpoint=endpoint,
+            testnet=self.testnet,
+            exchange=self.exchange
+        )
+        with self._stats_lock:
+            # Fenêtre pleine : la plus ancienne métrique sort des agrégats avant d'être évincée
+            if len(self.metrics) == self.metrics.maxlen:
+                self._remove_from_stats(self.metrics[0], self._next_seq - len(self.metrics))
+            self.metrics.append(metric)
+            self._add_to_stats(metric, self._next_seq)
+            self._next_seq += 1
         self._save_metrics()
         self._check_alerts(metric)
 
     def _save_metrics(self):
         """Sauvegarde les métriques dans un fichier JSON"""
         metrics_file = os.path.join(self.log_dir, 'metrics.json')
+        # Copie des références sous verrou : run() peut enregistrer pendant l'écriture
+        with self._stats_lock:
+            metrics = tuple(self.metrics)
         try:
             with open(metrics_file, 'w') as f:
-                json.dump(self.metrics, f)
+                f.write('[')
+                for i, metric in enumerate(metrics):
+                    if i:
+                        f.write(', ')
+                    f.write(metric.to_json())
+                f.write(']')
         except Exception as e:
             self.logger.error(f"Error saving metrics: {str(e)}")
 
-    def _check_alerts(self, metric: Dict):
+    def _check_alerts(self, metric: Metric):
         """Vérifie si une métrique déclenche une alerte"""
-        if metric['type'] == 'latency' and metric['value'] > self.alert_thresholds['latency']:
-            self.logger.warning(f"High latency detected: {metric['value']}ms for {metric['endpoint']}")
+        if metric.type == 'latency' and metric.value > self.alert_thresholds.latency:
+            self.logger.warning(f"High latency detected: {metric.value}ms for {metric.endpoint}")
         
-        elif metric['type'] == 'error':
+        elif metric.type == 'error':
             error_rate = self.failed_requests / self.total_requests if self.total_requests > 0 else 0
-            if error_rate > self.alert_thresholds['error_rate']:
+            if error_rate > self.alert_thresholds.error_rate:
                 self.logger.warning(f"High error rate detected: {error_rate:.2%}")
         
-        if self.consecutive_failures >= self.alert_thresholds['consecutive_failures']:
+        if self.consecutive_failures >= self.alert_thresholds.consecutive_failures:
             self.logger.error(f"Multiple consecutive failures detected: {self.consecutive_failures}")
 
+    def _latency_stats(self) -> Optional[Dict[str, float]]:
+        """Statistiques de latence de la fenêtre, lues sous verrou (None sans latence)"""
+        with self._stats_lock:
+            if not self._latency_count:
+                return None
+            return {
+                'avg_latency': self._latency_sum / self._latency_count,
+                'min_latency': self._latency_mins[0][1],
+                'max_latency': self._latency_maxs[0][1]
+            }
+
     def get_alerts(self) -> List[Dict]:
         """Récupère les alertes actives"""
         alerts = []
         
         # Vérifier la latency moyenne
-        latency_metrics = [m['value'] for m in self.metrics if m['type'] == 'latency']
-        if latency_metrics:
-            avg_latency = sum(latency_metrics) / len(latency_metrics)
-            if avg_latency > self.alert_thresholds['latency']:
+        latency_stats = self._latency_stats()
+        if latency_stats:
+            avg_latency = latency_stats['avg_latency']
+            if avg_latency > self.alert_thresholds.latency:
                 alerts.append({
                     'type': 'latency',
                     'message': f"High average latency: {avg_latency:.2f}ms",
-                    'threshold': self.alert_thresholds['latency'],
+                    'threshold': self.alert_thresholds.latency,
                     'value': avg_latency,
                     'timestamp': datetime.now().isoformat()
                 })
 
         # Vérifier le taux d'erreur
         error_rate = self.failed_requests / self.total_requests if self.total_requests > 0 else 0
-        if error_rate > self.alert_thresholds['error_rate']:
+        if error_rate > self.alert_thresholds.error_rate:
             alerts.append({
                 'type': 'error_rate',
                 'message': f"High error rate: {error_rate:.2%}",
-                'threshold': self.alert_thresholds['error_rate'],
+                'threshold': self.alert_thresholds.error_rate,
                 'value': error_rate,
                 'timestamp': datetime.now().isoformat()
             })
 
         # Vérifier les échecs consécutifs
-        if self.consecutive_failures >= self.alert_thresholds['consecutive_failures']:
+        if self.consecutive_failures >= self.alert_thresholds.consecutive_failures:
             alerts.append({
                 'type': 'consecutive_failures',
                 'message': f"Multiple consecutive failures: {self.consecutive_failures}",
-                'threshold': self.alert_thresholds['consecutive_failures'],
+                'threshold': self.alert_thresholds.consecutive_failures,
                 'value': self.consecutive_failures,
                 'timestamp': datetime.now().isoformat()
             })
@@ -268,14 +391,10 @@ class APIMonitor:
             'last_update': datetime.now().isoformat()
         }
         
-        # Calculer les statistiques de latence
-        latency_metrics = [m['value'] for m in self.metrics if m['type'] == 'latency']
-        if latency_metrics:
-            summary.update({
-                'avg_latency': sum(latency_metrics) / len(latency_metrics),
-                'min_latency': min(latency_metrics),
-                'max_latency': max(latency_metrics)
-            })
+        # Statistiques de latence sur la fenêtre des métriques conservées
+        latency_stats = self._latency_stats()
+        if latency_stats:
+            summary.update(latency_stats)
         
         return summary
 
@@ -350,7 +469,8 @@ class APIMonitor:
                 self.stop_event.wait(timeout=60)
             except Exception as e:
                 self.logger.error(f"Erreur dans la boucle de monitoring: {str(e)}")
-                time.sleep(5)  # Pause courte en cas d'erreur
+                # Pause courte en cas d'erreur, interrompue par stop()
+                self.stop_event.wait(timeout=5)
 
     def check_api_status(self):
         """Vérifie l'état de l'API"""
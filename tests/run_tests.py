@@ -1,23 +1,16 @@
-import unittest
 import sys
 import os
 
+import pytest
+
 # Ajouter le répertoire parent au PYTHONPATH
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 def run_all_tests():
     """Exécute tous les tests du projet"""
-    # Découvrir et charger tous les tests
-    loader = unittest.TestLoader()
+    # pytest collecte aussi bien les classes unittest.TestCase que les tests pytest (fixtures)
     start_dir = os.path.dirname(os.path.abspath(__file__))
-    suite = loader.discover(start_dir, pattern="test_*.py")
-    
-    # Exécuter les tests
-    runner = unittest.TextTestRunner(verbosity=2)
-    result = runner.run(suite)
-    
-    # Retourner le code de sortie approprié
-    return 0 if result.wasSuccessful() else 1
+    return int(pytest.main(["-v", start_dir]))
 
 if __name__ == "__main__":
     sys.exit(run_all_tests())
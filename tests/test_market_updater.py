@@ -1,332 +1,318 @@
-import unittest
-from unittest.mock import Mock, patch, create_autospec
-import time
-from datetime import datetime
-import os
+import pytest
 import pandas as pd
+from unittest.mock import Mock, patch
+import threading
+from datetime import datetime
+from types import MappingProxyType
 
 from src.services.market_updater import MarketUpdater
 from src.database.mongodb_manager import MongoDBManager
 from src.data_collector.market_data import MarketDataCollector
 from src.monitoring.api_monitor import APIMonitor
+from src.data_collector.technical_indicators import TechnicalAnalysis
+
+# Horodatages fixes : les tests n'ont pas besoin de l'heure courante
+_FIXED_TS = datetime(2024, 1, 1, 12, 0, 0)
+_FIXED_TS_MS = int(_FIXED_TS.timestamp() * 1000)
+
+# Statut de santé de l'API partagé, en lecture seule
+_API_OK = MappingProxyType({"status": "OK"})
+
+# Réponses du collecteur partagées par les tests (jamais modifiées par le MarketUpdater)
+_TICKER = {
+    'symbol': 'BTCUSDT',
+    'last_price': '50000',
+    'volume_24h': '1000'
+}
+_ORDERBOOK = {
+    'bids': [['49999', '1.0']],
+    'asks': [['50001', '1.0']]
+}
+_TRADES = [{
+    'price': '50000',
+    'qty': '1.0',
+    'time': 1000000
+}]
+
+# Attributs des composants mockés, introspectés une seule fois
+_DB_SPEC = dir(MongoDBManager)
+_COLLECTOR_SPEC = dir(MarketDataCollector)
+_TECHNICAL_ANALYSIS_SPEC = dir(TechnicalAnalysis)
+_API_MONITOR_SPEC = dir(APIMonitor)
+
+# Fixtures communs
+@pytest.fixture(scope="module")
+def klines_df():
+    """Fixture pour construire une seule fois le DataFrame de klines"""
+    return pd.DataFrame({
+        'timestamp': [1, 2, 3],
+        'open': [100, 101, 102],
+        'high': [103, 104, 105],
+        'low': [98, 99, 100],
+        'close': [101, 102, 103],
+        'volume': [1000, 1100, 1200]
+    })
+
+@pytest.fixture
+def mock_collector(klines_df):
+    """Fixture pour le mock du collecteur de données, configuré pour le cas nominal"""
+    mock_collector = Mock(spec_set=_COLLECTOR_SPEC)
+    mock_collector.configure_mock(**{
+        'get_ticker.return_value': _TICKER,
+        'get_klines.return_value': klines_df,
+        'get_order_book.return_value': _ORDERBOOK,
+        'get_public_trade_history.return_value': _TRADES
+    })
+    return mock_collector
+
+@pytest.fixture
+def mock_db():
+    """Fixture pour le mock de la base de données"""
+    mock_db = Mock(spec_set=_DB_SPEC)
+    mock_db.store_market_data.return_value = True
+    mock_db.store_indicators.return_value = True
+    return mock_db
+
+@pytest.fixture
+def mock_technical_analysis():
+    """Fixture pour le mock de l'analyse technique"""
+    mock_technical_analysis = Mock(spec_set=_TECHNICAL_ANALYSIS_SPEC)
+    # Nouveau dict à chaque test : le MarketUpdater y ajoute symbol et timestamp
+    mock_technical_analysis.get_summary.return_value = {
+        'RSI': 65.0,
+        'MACD': 0.5,
+        'MA20': 102.0
+    }
+    return mock_technical_analysis
 
-class TestMarketUpdater(unittest.TestCase):
-    def setUp(self):
-        """Configuration initiale des tests"""
-        # Création des mocks
-        self.mock_collector = Mock()
-        self.mock_db = create_autospec(MongoDBManager)
-        self.mock_technical_analysis = Mock()
-        self.mock_api_monitor = Mock()
-        
-        # Configuration du MarketUpdater avec les mocks
-        self.market_updater = MarketUpdater(['BTCUSDT'], db=self.mock_db)
-        self.market_updater.collector = self.mock_collector
-        self.market_updater.technical_analysis = self.mock_technical_analysis
-        self.market_updater.api_monitor = self.mock_api_monitor
-        
-        # Configuration des retours par défaut
-        self.mock_api_monitor.check_api_health.return_value = {"status": "OK"}
-        self.mock_db.store_market_data.return_value = True
-        self.mock_db.store_indicators.return_value = True
-        
-        # Reduce intervals for faster tests
-        self.market_updater.update_interval = 0.1  # 100ms instead of 10s
-        self.market_updater.shutdown_timeout = 1  # 1s instead of 10s
-
-    def tearDown(self):
-        """Nettoyage après chaque test"""
-        if hasattr(self.market_updater, 'stop'):
-            self.market_updater.stop()
-        # Reset all mocks
-        self.mock_collector.reset_mock()
-        self.mock_db.reset_mock()
-        self.mock_technical_analysis.reset_mock()
-        self.mock_api_monitor.reset_mock()
-
-    def test_init(self):
+@pytest.fixture
+def mock_api_monitor():
+    """Fixture pour le mock du moniteur d'API"""
+    mock_api_monitor = Mock(spec_set=_API_MONITOR_SPEC)
+    mock_api_monitor.check_api_health.return_value = _API_OK
+    return mock_api_monitor
+
+@pytest.fixture(scope="module")
+def shared_market_updater():
+    """Fixture pour construire une seule fois le MarketUpdater du module"""
+    return MarketUpdater(['BTCUSDT'], db=Mock(spec_set=_DB_SPEC))
+
+@pytest.fixture
+def market_updater(shared_market_updater, mock_collector, mock_db, mock_technical_analysis, mock_api_monitor):
+    """Fixture pour réinitialiser le MarketUpdater partagé et y brancher les mocks"""
+    market_updater = shared_market_updater
+    market_updater.db = mock_db
+    market_updater.collector = mock_collector
+    market_updater.technical_analysis = mock_technical_analysis
+    market_updater.api_monitor = mock_api_monitor
+
+    # Réinitialisation de l'état laissé par le test précédent
+    market_updater.last_update = {'BTCUSDT': 0}
+    market_updater.error_counts = {'BTCUSDT': 0}
+    market_updater.stop_event.clear()
+    market_updater.shutdown_complete.clear()
+
+    # Pas d'attente entre deux itérations : les tests pilotent la boucle par événements
+    market_updater.update_interval = 0
+
+    yield market_updater
+
+    # Arrêt du thread uniquement s'il est encore actif
+    update_thread = market_updater.update_thread
+    if update_thread is not None and update_thread.is_alive():
+        market_updater.stop()
+
+class TestMarketUpdater:
+    """Tests pour le service de mise à jour des données de marché"""
+
+    def test_init(self, market_updater, mock_db):
         """Test de l'initialisation du MarketUpdater"""
-        self.assertEqual(self.market_updater.symbols, ['BTCUSDT'])
-        self.assertEqual(self.market_updater.db, self.mock_db)
-        self.assertEqual(self.market_updater.error_counts, {'BTCUSDT': 0})
+        assert market_updater.symbols == ['BTCUSDT']
+        assert market_updater.db == mock_db
+        assert market_updater.error_counts == {'BTCUSDT': 0}
 
-    def test_update_market_data_success(self):
-        """Test de la mise à jour réussie des données de marché"""
+    def test_update_market_data_success(self, market_updater, mock_collector, mock_db, mock_technical_analysis):
+        """Test de la mise à jour réussie des données de marché et des indicateurs techniques"""
         symbol = "BTCUSDT"
-        
-        # Configuration des mocks avec le format correct des données
-        self.mock_collector.get_ticker.return_value = {
-            'symbol': symbol,
-            'last_price': '50000',
-            'volume_24h': '1000'
-        }
-        self.mock_collector.get_klines.return_value = pd.DataFrame({
-            'timestamp': [1, 2, 3],
-            'open': [100, 101, 102],
-            'high': [103, 104, 105],
-            'low': [98, 99, 100],
-            'close': [101, 102, 103],
-            'volume': [1000, 1100, 1200]
-        })
-        self.mock_collector.get_order_book.return_value = {
-            'bids': [['49999', '1.0']],
-            'asks': [['50001', '1.0']]
-        }
-        self.mock_collector.get_public_trade_history.return_value = [{
-            'price': '50000',
-            'qty': '1.0',
-            'time': 1000000
-        }]
-        
-        # Configuration du mock des indicateurs techniques
-        self.mock_technical_analysis.get_summary.return_value = {
-            'RSI': 65.0,
-            'MACD': 0.5,
-            'MA20': 102.0
-        }
-        
+        technical_indicators = mock_technical_analysis.get_summary.return_value
+
+        # Capture directe des données sauvegardées
+        saved = []
+        mock_db.store_market_data.side_effect = lambda data: saved.append(data) or True
+        stored = []
+        mock_db.store_indicators.side_effect = lambda **kwargs: stored.append(kwargs) or True
+
         # Exécution de la mise à jour
-        result = self.market_updater.update_market_data(symbol)
-        
+        result = market_updater.update_market_data(symbol)
+
         # Vérifications
-        self.assertTrue(result)
-        self.mock_collector.get_ticker.assert_called_once_with(symbol)
-        self.mock_collector.get_klines.assert_called_once()
-        self.mock_collector.get_order_book.assert_called_once()
-        self.mock_collector.get_public_trade_history.assert_called_once()
-        
+        assert result is True
+        mock_collector.get_ticker.assert_called_once_with(symbol)
+        mock_collector.get_klines.assert_called_once()
+        mock_collector.get_order_book.assert_called_once()
+        mock_collector.get_public_trade_history.assert_called_once()
+
         # Vérification de la sauvegarde des données
-        self.mock_db.store_market_data.assert_called_once()
-        saved_data = self.mock_db.store_market_data.call_args[0][0]  # Accéder au premier argument positif
-        self.assertEqual(saved_data['symbol'], symbol)
-        self.assertIn('timestamp', saved_data)
-        self.assertIn('data', saved_data)
-        self.assertIn('ticker', saved_data['data'])
-        self.assertIn('klines', saved_data['data'])
-        self.assertIn('orderbook', saved_data['data'])
-        self.assertIn('trades', saved_data['data'])
-        self.assertEqual(saved_data['data']['exchange'], 'bybit')
-
-    def test_update_market_data_failure(self):
+        assert len(saved) == 1
+        saved_data = saved[0]
+        assert saved_data['symbol'] == symbol
+        assert saved_data.keys() >= {'timestamp', 'data'}
+        assert saved_data['data'].keys() >= {'ticker', 'klines', 'orderbook', 'trades', 'exchange'}
+        assert saved_data['data']['exchange'] == 'bybit'
+
+        # Vérification des indicateurs techniques stockés
+        mock_technical_analysis.get_summary.assert_called_once()
+        assert len(stored) == 1
+        stored_data = stored[0]
+        assert stored_data['symbol'] == symbol
+        assert stored_data['indicators'] == technical_indicators
+
+    @pytest.mark.parametrize("mock_name, failure, ticker_calls", [
+        # Erreur levée par le collecteur
+        ("mock_collector", {"get_ticker.side_effect": Exception("API Error")}, 1),
+        # API non disponible : aucune collecte n'est tentée
+        ("mock_api_monitor", {"check_api_health.return_value": {"status": "ERROR"}}, 0),
+    ], ids=["api_error", "api_unhealthy"])
+    def test_update_market_data_failure(self, request, market_updater, mock_collector, mock_db,
+                                        mock_name, failure, ticker_calls):
         """Test de la gestion des erreurs lors de la mise à jour"""
         symbol = 'BTCUSDT'
-        
-        # Configuration du mock pour lever une exception
-        self.mock_collector.get_ticker.side_effect = Exception("API Error")
-        
+
+        # Configuration du mock pour simuler la défaillance
+        request.getfixturevalue(mock_name).configure_mock(**failure)
+
         # Exécution de la mise à jour
-        result = self.market_updater.update_market_data(symbol)
-        
+        result = market_updater.update_market_data(symbol)
+
         # Vérifications
-        self.assertFalse(result)
-        self.assertEqual(self.market_updater.error_counts[symbol], 1)
-        self.mock_db.store_market_data.assert_not_called()
+        assert result is False
+        assert market_updater.error_counts[symbol] == 1
+        assert mock_collector.get_ticker.call_count == ticker_calls
+        mock_db.store_market_data.assert_not_called()
 
-    def test_run_and_stop(self):
+    def test_run_and_stop(self, market_updater, mock_db):
         """Test du démarrage et de l'arrêt du service"""
-        # Configuration des mocks pour une exécution réussie
-        self.mock_collector.get_ticker.return_value = {
-            'symbol': 'BTCUSDT',
-            'last_price': '50000',
-            'volume_24h': '1000'
-        }
-        self.mock_collector.get_klines.return_value = pd.DataFrame({
-            'timestamp': [1, 2, 3],
-            'open': [100, 101, 102],
-            'high': [103, 104, 105],
-            'low': [98, 99, 100],
-            'close': [101, 102, 103],
-            'volume': [1000, 1100, 1200]
-        })
-        self.mock_technical_analysis.get_summary.return_value = {
-            'RSI': 65.0,
-            'MACD': 0.5,
-            'MA20': 102.0
-        }
-        
+        # Signalement de la première mise à jour par le mock
+        updated = threading.Event()
+
+        def _signal(*args, **kwargs):
+            updated.set()
+            return True
+
+        mock_db.store_indicators.side_effect = _signal
+
         # Démarrage du service dans un thread séparé
-        self.market_updater.start()
-        
+        market_updater.start()
+
         # Attente d'au moins une mise à jour
-        time.sleep(0.2)
-        
+        assert updated.wait(timeout=2)
+
         # Arrêt du service
-        self.market_updater.stop()
-        
+        market_updater.stop()
+
         # Attente de l'arrêt complet
-        self.market_updater.shutdown_complete.wait(timeout=1)
-        
-        # Vérifications
-        self.mock_db.store_market_data.assert_called()
-        self.mock_db.store_indicators.assert_called()
-        self.assertTrue(self.market_updater.stop_event.is_set())
+        assert market_updater.shutdown_complete.wait(timeout=2)
 
-    def test_api_health_check_failure(self):
-        """Test de la gestion d'une API non disponible"""
-        symbol = 'BTCUSDT'
-        
-        # Configuration du mock pour simuler une API non disponible
-        self.mock_api_monitor.check_api_health.return_value = {"status": "ERROR"}
-        
-        # Exécution de la mise à jour
-        result = self.market_updater.update_market_data(symbol)
-        
         # Vérifications
-        self.assertFalse(result)
-        self.assertEqual(self.market_updater.error_counts[symbol], 1)
-        self.mock_collector.get_ticker.assert_not_called()
-        self.mock_db.store_market_data.assert_not_called()
+        mock_db.store_market_data.assert_called()
+        mock_db.store_indicators.assert_called()
+        assert market_updater.stop_event.is_set()
 
-    def test_technical_indicators_update_success(self):
-        """Test de la mise à jour réussie des indicateurs techniques"""
-        symbol = "BTCUSDT"
-        timestamp = int(time.time() * 1000)
-        
-        # Configuration des mocks
-        klines_data = pd.DataFrame({
-            'timestamp': [timestamp - 200000, timestamp - 100000, timestamp],
-            'open': [100, 101, 102],
-            'high': [103, 104, 105],
-            'low': [98, 99, 100],
-            'close': [101, 102, 103],
-            'volume': [1000, 1100, 1200]
-        })
-        
-        technical_indicators = {
-            'RSI': 65.0,
-            'MACD': 0.5,
-            'MA20': 102.0
-        }
-        
-        self.mock_collector.get_klines.return_value = klines_data
-        self.mock_technical_analysis.get_summary.return_value = technical_indicators
-        
-        # Exécution
-        result = self.market_updater.update_market_data(symbol)
-        
-        # Vérifications
-        self.assertTrue(result)
-        self.mock_technical_analysis.get_summary.assert_called_once()
-        self.mock_db.store_indicators.assert_called_once()
-        
-        # Vérification des données stockées
-        stored_data = self.mock_db.store_indicators.call_args.kwargs
-        self.assertEqual(stored_data['symbol'], symbol)
-        self.assertEqual(stored_data['indicators'], technical_indicators)
-
-    def test_technical_indicators_invalid_data(self):
+    def test_technical_indicators_invalid_data(self, market_updater, mock_collector, mock_db):
         """Test de la gestion des données invalides pour les indicateurs techniques"""
         symbol = 'BTCUSDT'
-        timestamp = datetime.now()
-        
+
         # Configuration des mocks avec des données valides pour tout sauf klines
-        self.mock_collector.get_ticker.return_value = {
+        mock_collector.get_ticker.return_value = {
             'symbol': symbol,
             'last_price': 50000.0,
             'volume_24h': 1000.0,
-            'timestamp': timestamp.timestamp()
+            'timestamp': _FIXED_TS_MS / 1000
         }
-        
+
         # Retourner des données invalides pour klines (pas un DataFrame)
-        self.mock_collector.get_klines.return_value = {
+        mock_collector.get_klines.return_value = {
             'error': 'Invalid data format'
         }
-        
-        self.mock_collector.get_order_book.return_value = {
+
+        mock_collector.get_order_book.return_value = {
             'lastUpdateId': 1234567,
             'bids': [['49999', '1.0']],
             'asks': [['50001', '1.0']]
         }
-        
-        self.mock_collector.get_public_trade_history.return_value = [{
+
+        mock_collector.get_public_trade_history.return_value = [{
             'id': 12345,
             'price': '50000',
             'qty': '1.0',
-            'time': int(timestamp.timestamp() * 1000),
+            'time': _FIXED_TS_MS,
             'isBuyerMaker': True
         }]
-        
+
         # Exécution de la mise à jour
-        result = self.market_updater.update_market_data(symbol)
-        
+        result = market_updater.update_market_data(symbol)
+
         # Vérifications
-        self.assertTrue(result)  # La mise à jour doit réussir même si les indicateurs échouent
-        self.mock_db.store_market_data.assert_called_once()  # Les données de marché sont toujours stockées
-        self.mock_db.store_indicators.assert_not_called()  # Pas de stockage d'indicateurs
+        assert result is True  # La mise à jour doit réussir même si les indicateurs échouent
+        mock_db.store_market_data.assert_called_once()  # Les données de marché sont toujours stockées
+        mock_db.store_indicators.assert_not_called()  # Pas de stockage d'indicateurs
 
-    def test_update_deduplication(self):
+    def test_update_deduplication(self, market_updater, mock_collector):
         """Test que les mises à jour trop rapprochées sont différées"""
         symbol = "BTCUSDT"
-        
-        # Configuration des mocks avec les bonnes méthodes
-        self.mock_collector.get_ticker.return_value = {
-            'symbol': symbol,
-            'last_price': '50000',
-            'volume_24h': '1000'
-        }
-        self.mock_collector.get_klines.return_value = pd.DataFrame({
-            'timestamp': [1, 2, 3],
-            'open': [100, 101, 102],
-            'high': [103, 104, 105],
-            'low': [98, 99, 100],
-            'close': [101, 102, 103],
-            'volume': [1000, 1100, 1200]
-        })
-        self.mock_collector.get_order_book.return_value = {
-            'bids': [['49999', '1.0']],
-            'asks': [['50001', '1.0']]
-        }
-        self.mock_collector.get_public_trade_history.return_value = [{
-            'price': '50000',
-            'qty': '1.0',
-            'time': 1000000
-        }]
-        self.mock_api_monitor.check_api_health.return_value = {"status": "OK"}
-        self.mock_technical_analysis.get_summary.return_value = {
-            'RSI': 65.0,
-            'MACD': 0.5
-        }
-        
-        # Première mise à jour
-        self.assertTrue(self.market_updater.update_market_data(symbol))
-        first_update_time = self.market_updater.last_update[symbol]
-        
-        # Tentative de mise à jour immédiate
-        self.assertTrue(self.market_updater.update_market_data(symbol))
-        
-        # Vérifier que le mock n'a été appelé qu'une seule fois
-        self.assertEqual(self.mock_collector.get_ticker.call_count, 1)
-        
-        # Attendre que l'intervalle soit passé
-        time.sleep(self.market_updater.update_interval + 0.1)
-        
-        # Nouvelle mise à jour
-        self.assertTrue(self.market_updater.update_market_data(symbol))
-        second_update_time = self.market_updater.last_update[symbol]
-        
+
+        # Horloge simulée : mise à jour, tentative 1s plus tard, puis après l'intervalle
+        market_updater.update_interval = 10
+        with patch('src.services.market_updater.time') as mock_time:
+            mock_time.time.side_effect = [1000.0, 1001.0, 1011.0]
+
+            # Première mise à jour
+            assert market_updater.update_market_data(symbol) is True
+            first_update_time = market_updater.last_update[symbol]
+
+            # Tentative de mise à jour immédiate
+            assert market_updater.update_market_data(symbol) is True
+
+            # Vérifier que le mock n'a été appelé qu'une seule fois
+            assert mock_collector.get_ticker.call_count == 1
+
+            # Nouvelle mise à jour une fois l'intervalle écoulé
+            assert market_updater.update_market_data(symbol) is True
+            second_update_time = market_updater.last_update[symbol]
+
         # Vérifier que la deuxième mise à jour a bien eu lieu
-        self.assertEqual(self.mock_collector.get_ticker.call_count, 2)
-        self.assertGreater(second_update_time, first_update_time)
+        assert mock_collector.get_ticker.call_count == 2
+        assert second_update_time > first_update_time
 
-    def test_graceful_shutdown(self):
+    def test_graceful_shutdown(self, market_updater, mock_db):
         """Test de l'arrêt propre du service"""
+        # Rendez-vous entre le test et la première itération de la boucle
+        first_update = threading.Barrier(2)
+
+        def _rendezvous(*args, **kwargs):
+            if mock_db.store_market_data.call_count == 1:
+                first_update.wait(timeout=2)
+            return True
+
+        mock_db.store_market_data.side_effect = _rendezvous
+
         # Démarrer le service
-        self.market_updater.start()
-        time.sleep(0.2)  # Laisser le temps au thread de démarrer
-        
+        market_updater.start()
+        first_update.wait(timeout=2)  # Le thread effectue sa première mise à jour
+
         # Vérifier que le service tourne
-        self.assertTrue(self.market_updater.update_thread.is_alive())
-        
+        assert market_updater.update_thread.is_alive()
+
         # Sauvegarder une référence au thread
-        update_thread = self.market_updater.update_thread
-        
+        update_thread = market_updater.update_thread
+
         # Demander l'arrêt
-        self.market_updater.stop()
-        
+        market_updater.stop()
+
         # Vérifier que le thread s'est arrêté proprement
-        update_thread.join(timeout=2)
-        self.assertFalse(update_thread.is_alive())
-        self.assertTrue(self.market_updater.shutdown_complete.is_set())
+        update_thread.join(timeout=0.05)
+        assert not update_thread.is_alive()
+        assert market_updater.shutdown_complete.is_set()
 
-if __name__ == '__main__':
-    unittest.main()
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
@@ -1,33 +1,40 @@
 import unittest
+import os
 from datetime import datetime, timedelta
-from unittest.mock import patch, MagicMock
-from src.database.mongodb_manager import MongoDBManager
-import time
+from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+from pymongo.write_concern import WriteConcern
+from src.database.mongodb_manager import MongoDBManager, get_mongodb_uri
 from datetime import timezone as tz
+import mongomock
+import pytest
+
+def _restrict(documents, expected):
+    """Restreint les documents récupérés aux clés attendues, pour une comparaison structurelle"""
+    return [{k: v for k, v in document.items() if k in expected} for document in documents]
+
+class TestMongoDBManagerUnit(unittest.TestCase):
+    """Tests de la mise en forme des documents, sur une base mongomock en mémoire"""
 
-class TestMongoDBManager(unittest.TestCase):
     def setUp(self):
-        """Configuration initiale pour chaque test"""
-        self.mongodb_manager = MongoDBManager()
-        # Nettoyage des collections avant chaque test
-        self.mongodb_manager.market_data.delete_many({})
-        self.mongodb_manager.indicators.delete_many({})
-        self.mongodb_manager.trades.delete_many({})
-        self.mongodb_manager.monitoring.delete_many({})
-        self.mongodb_manager.api_metrics.delete_many({})
-        self.mongodb_manager.strategy_config.delete_many({})
-        
+        """Base en mémoire neuve pour chaque test"""
+        # Horodatage de référence unique pour le test
+        self.now = datetime.now(tz.utc)
+        with patch('src.database.mongodb_manager.MongoClient', mongomock.MongoClient):
+            self.mongodb_manager = MongoDBManager(db_name='test_bybit_unit')
+
     def tearDown(self):
-        """Nettoie après les tests"""
-        if hasattr(self.mongodb_manager, 'client'):
-            self.mongodb_manager.client.close()
+        """Ferme la connexion en mémoire"""
+        self.mongodb_manager.close()
 
     def test_store_and_retrieve_market_data(self):
         """Teste le stockage et la récupération des données de marché"""
         symbol = "BTCUSDT"
         data = {
             "symbol": symbol,
-            "timestamp": datetime.now(tz.utc),
+            "timestamp": self.now,
             "data": {
                 "ticker": {
                     "price": 50000.0
@@ -57,13 +64,202 @@ class TestMongoDBManager(unittest.TestCase):
         self.mongodb_manager.store_indicators(symbol, test_indicators)
         
         # Récupération des indicateurs
-        retrieved_indicators = self.mongodb_manager.get_latest_indicators(symbol, limit=1)
+        retrieved_indicators = self.mongodb_manager.get_latest_indicators(
+            symbol, limit=1, fields=["symbol", "indicators"]
+        )
         
         # Vérifications
         self.assertIsNotNone(retrieved_indicators)
-        self.assertEqual(len(retrieved_indicators), 1)
-        self.assertEqual(retrieved_indicators[0]["symbol"], symbol)
-        self.assertEqual(retrieved_indicators[0]["indicators"], test_indicators)
+        expected = {"symbol": symbol, "indicators": test_indicators}
+        self.assertEqual(_restrict(retrieved_indicators, expected), [expected])
+
+    def test_store_and_retrieve_strategy_config(self):
+        """Teste le stockage et la récupération de la configuration de stratégie"""
+        # Données de test
+        strategy_name = "RSI_Strategy"
+        config_data = {
+            "rsi_period": 14,
+            "overbought": 70,
+            "oversold": 30
+        }
+        
+        # Stockage de la configuration
+        self.mongodb_manager.store_strategy_config(strategy_name, config_data)
+        
+        # Récupération de la configuration
+        retrieved_config = self.mongodb_manager.get_strategy_config(strategy_name)
+        
+        # Vérifications
+        self.assertIsNotNone(retrieved_config)
+        self.assertEqual(retrieved_config["strategy_name"], strategy_name)
+        self.assertEqual(retrieved_config["config"], config_data)
+
+    def test_store_strategy_config_replaces_previous(self):
+        """Teste qu'une nouvelle configuration remplace la précédente"""
+        strategy_name = "RSI_Strategy"
+        self.mongodb_manager.store_strategy_config(strategy_name, {"rsi_period": 14})
+        self.mongodb_manager.store_strategy_config(strategy_name, {"rsi_period": 21})
+        
+        # Vérifications
+        self.assertEqual(
+            self.mongodb_manager.strategy_config.count_documents({"strategy_name": strategy_name}), 1
+        )
+        retrieved_config = self.mongodb_manager.get_strategy_config(strategy_name)
+        self.assertEqual(retrieved_config["config"], {"rsi_period": 21})
+
+    def test_has_monitoring_since(self):
+        """Teste la vérification d'existence des données de monitoring"""
+        self.mongodb_manager.store_monitoring_data({"endpoint": "test", "status": "success"})
+
+        # Vérifications
+        self.assertTrue(self.mongodb_manager.has_monitoring_since(self.now - timedelta(minutes=1)))
+        self.assertFalse(self.mongodb_manager.has_monitoring_since(self.now + timedelta(minutes=1)))
+
+    def test_has_monitoring_since_connection_lost(self):
+        """Teste que la perte de connexion renvoie False au lieu de lever une exception"""
+        self.mongodb_manager.store_monitoring_data({"endpoint": "test", "status": "success"})
+        with patch.object(self.mongodb_manager.client.admin, 'command', side_effect=Exception("ping failed")):
+            self.assertFalse(self.mongodb_manager.has_monitoring_since(self.now - timedelta(minutes=1)))
+
+    def test_store_strategy_configs_bulk_connection_lost(self):
+        """Teste qu'aucune écriture n'est tentée quand la connexion est perdue"""
+        with patch.object(self.mongodb_manager.client.admin, 'command', side_effect=Exception("ping failed")), \
+             patch.object(self.mongodb_manager, 'strategy_config') as strategy_config:
+            self.mongodb_manager.store_strategy_configs_bulk({"RSI_Strategy": {"rsi_period": 14}})
+
+        strategy_config.bulk_write.assert_not_called()
+
+    def test_bulk_stores_write_concern(self):
+        """Vérifie que les insertions en masse sont non ordonnées et que seul fast_insert désactive l'acquittement"""
+        insert_many = mongomock.collection.Collection.insert_many
+        calls = []
+
+        def _insert_many(collection, documents, **kwargs):
+            calls.append((collection.name, collection.write_concern, kwargs))
+            return insert_many(collection, documents, **kwargs)
+
+        with patch.object(mongomock.collection.Collection, 'insert_many', _insert_many):
+            for fast_insert in (False, True):
+                self.mongodb_manager.store_market_data_bulk(
+                    [{"symbol": "BTCUSDT", "data": {"price": 50000.0}}], fast_insert=fast_insert
+                )
+                self.mongodb_manager.store_indicators_bulk(
+                    [{"symbol": "BTCUSDT", "indicators": {"rsi": 65.5}}], fast_insert=fast_insert
+                )
+
+        # Vérifications : écritures acquittées par défaut, w=0 avec fast_insert
+        market_data, indicators = self.mongodb_manager.market_data.name, self.mongodb_manager.indicators.name
+        self.assertEqual([(name, kwargs) for name, _, kwargs in calls], [
+            (market_data, {"ordered": False}), (indicators, {"ordered": False}),
+            (market_data, {"ordered": False}), (indicators, {"ordered": False})
+        ])
+        self.assertEqual([write_concern.acknowledged for _, write_concern, _ in calls], [True, True, False, False])
+        self.assertEqual([write_concern for _, write_concern, _ in calls[2:]], [WriteConcern(w=0)] * 2)
+
+    def test_write_concern_defaults_only_for_default_uri(self):
+        """Vérifie que les options d'écriture d'une URI fournie ne sont pas écrasées"""
+        with patch('src.database.mongodb_manager.MongoClient') as client_class:
+            MongoDBManager(db_name='test_bybit_unit')
+            MongoDBManager(uri="mongodb://localhost:27017/?w=1&journal=false", db_name='test_bybit_unit')
+
+        default_call, uri_call = client_class.call_args_list
+        self.assertEqual(default_call.kwargs, {'w': 'majority', 'journal': True})
+        self.assertEqual(uri_call.args, ("mongodb://localhost:27017/?w=1&journal=false",))
+        self.assertEqual(uri_call.kwargs, {})
+
+    def test_monitoring_ttl_indexes(self):
+        """Vérifie que les données de monitoring expirent via un index TTL"""
+        expected = [
+            (self.mongodb_manager.monitoring, self.mongodb_manager.monitoring_ttl_days * 86400),
+            (self.mongodb_manager.api_metrics, self.mongodb_manager.api_metrics_ttl_days * 86400)
+        ]
+        for collection, ttl in expected:
+            ttls = [index.get("expireAfterSeconds") for index in collection.index_information().values()]
+            self.assertIn(ttl, ttls)
+
+    def test_ttl_index_update_on_existing_database(self):
+        """Vérifie qu'un changement de rétention modifie l'index TTL existant au lieu d'échouer"""
+        client = self.mongodb_manager.client
+        with patch.dict(os.environ, {'MONGODB_MONITORING_TTL_DAYS': '14'}), \
+             patch.object(mongomock.database.Database, 'command') as command:
+            MongoDBManager(client=client, db_name='test_bybit_unit')
+
+        command.assert_called_once_with(
+            "collMod", self.mongodb_manager.monitoring.name,
+            index={"keyPattern": {"timestamp": 1}, "expireAfterSeconds": 14 * 86400}
+        )
+
+    def test_legacy_timestamp_index_dropped(self):
+        """Vérifie que l'ancien index timestamp descendant est supprimé au profit de l'index TTL"""
+        for collection in (self.mongodb_manager.monitoring, self.mongodb_manager.api_metrics):
+            collection.create_index([("timestamp", -1)])
+
+        MongoDBManager(client=self.mongodb_manager.client, db_name='test_bybit_unit')
+
+        for collection in (self.mongodb_manager.monitoring, self.mongodb_manager.api_metrics):
+            indexes = collection.index_information()
+            self.assertNotIn("timestamp_-1", indexes)
+            self.assertIn("timestamp_1", indexes)
+
+    def test_ttl_index_migration_race(self):
+        """Vérifie qu'une migration des index déjà faite par un autre processus ne bloque pas le constructeur"""
+        self.mongodb_manager.monitoring.create_index([("timestamp", -1)])
+        self.mongodb_manager.api_metrics.drop_index("timestamp_1")
+        create_index = mongomock.collection.Collection.create_index
+
+        def _create_index(collection, keys, **kwargs):
+            # Seule la création de l'index TTL entre en conflit
+            if kwargs.get("expireAfterSeconds") is not None:
+                raise OperationFailure("index options conflict", code=85)
+            return create_index(collection, keys, **kwargs)
+
+        with patch.object(mongomock.collection.Collection, 'drop_index',
+                          side_effect=OperationFailure("index not found", code=27)), \
+             patch.object(mongomock.collection.Collection, 'create_index', _create_index):
+            MongoDBManager(client=self.mongodb_manager.client, db_name='test_bybit_unit')
+
+        # Toute autre erreur serveur reste remontée
+        with patch.object(mongomock.collection.Collection, 'drop_index',
+                          side_effect=OperationFailure("unauthorized", code=13)):
+            with self.assertRaises(OperationFailure):
+                MongoDBManager(client=self.mongodb_manager.client, db_name='test_bybit_unit')
+
+@pytest.mark.integration
+class TestMongoDBManagerIntegration(unittest.TestCase):
+    # Collections vidées avant chaque test
+    COLLECTIONS = ('market_data', 'indicators', 'trades', 'monitoring', 'api_metrics', 'strategy_config')
+
+    @classmethod
+    def setUpClass(cls):
+        """MongoDBManager partagé par la classe de tests, sur un client MongoDB unique"""
+        # Écritures acquittées par le primaire sans attendre le journal : les tests n'ont pas besoin de durabilité
+        cls.mongo_client = MongoClient(get_mongodb_uri(), maxPoolSize=20, minPoolSize=5, maxIdleTimeMS=300000,
+                                       w=1, journal=False)
+        # Une base par worker pytest-xdist : les workers ne se vident pas mutuellement leurs collections
+        cls.db_name = f"test_bybit_{os.environ.get('PYTEST_XDIST_WORKER', 'gw0')}"
+        cls.mongodb_manager = MongoDBManager(client=cls.mongo_client, db_name=cls.db_name)
+        # Collections résolues une seule fois pour la remise à zéro
+        cls.collections = tuple(getattr(cls.mongodb_manager, name) for name in cls.COLLECTIONS)
+        cls.executor = ThreadPoolExecutor(max_workers=len(cls.COLLECTIONS))
+
+    @classmethod
+    def tearDownClass(cls):
+        """Supprime la base de test et ferme le client"""
+        cls.executor.shutdown()
+        cls.mongodb_manager.close()
+        cls.mongo_client.drop_database(cls.db_name)
+        cls.mongo_client.close()
+
+    def setUp(self):
+        """Configuration initiale pour chaque test"""
+        # Horodatage de référence unique pour le test
+        self.now = datetime.now(tz.utc)
+        # Nettoyage des collections avant chaque test
+        self._reset_collections()
+
+    def _reset_collections(self):
+        """Vide les collections en parallèle plutôt qu'un aller-retour après l'autre"""
+        list(self.executor.map(lambda collection: collection.delete_many({}), self.collections))
 
     def test_store_and_retrieve_trades(self):
         """Teste le stockage et la récupération des transactions"""
@@ -75,20 +271,18 @@ class TestMongoDBManager(unittest.TestCase):
             "quantity": 1.0
         }
         
+        # Copie : le stockage ajoute _id et timestamp au document
+        expected = dict(trade_data)
+        
         # Stockage de la transaction
         self.mongodb_manager.store_trade(trade_data)
         
         # Récupération des transactions
-        start_time = datetime.now(tz.utc) - timedelta(minutes=1)
+        start_time = self.now - timedelta(minutes=1)
         trades = self.mongodb_manager.get_trades_by_timeframe(start_time)
         
         # Vérifications
-        self.assertEqual(len(trades), 1)
-        retrieved_trade = trades[0]
-        self.assertEqual(retrieved_trade["symbol"], trade_data["symbol"])
-        self.assertEqual(retrieved_trade["side"], trade_data["side"])
-        self.assertEqual(retrieved_trade["price"], trade_data["price"])
-        self.assertEqual(retrieved_trade["quantity"], trade_data["quantity"])
+        self.assertEqual(_restrict(trades, expected), [expected])
 
     def test_store_and_retrieve_monitoring_data(self):
         """Teste le stockage et la récupération des données de monitoring"""
@@ -100,18 +294,13 @@ class TestMongoDBManager(unittest.TestCase):
         }
         self.mongodb_manager.store_monitoring_data(test_data)
         
-        # Attendre un peu pour s'assurer que les données sont stockées
-        time.sleep(0.1)
-        
         # Définir une plage de temps qui inclut certainement nos données
         end_time = datetime.now(tz.utc)
         start_time = end_time - timedelta(minutes=1)
         
         # Récupération et vérification
+        self.assertTrue(self.mongodb_manager.has_monitoring_since(start_time))
         result = self.mongodb_manager.get_monitoring_data(start_time, end_time)
-        
-        self.assertIsInstance(result, list)
-        self.assertTrue(len(result) > 0)
         self.assertEqual(result[0]["endpoint"], "test")
         self.assertEqual(result[0]["status"], "success")
 
@@ -124,6 +313,9 @@ class TestMongoDBManager(unittest.TestCase):
             "value": 0.2
         }
         
+        # Copie : le stockage ajoute _id et timestamp au document
+        expected = dict(metric_data)
+        
         # Stockage des métriques
         self.mongodb_manager.store_api_metric(metric_data)
         
@@ -134,37 +326,13 @@ class TestMongoDBManager(unittest.TestCase):
         )
         
         # Vérifications
-        self.assertEqual(len(retrieved_metrics), 1)
-        self.assertEqual(retrieved_metrics[0]["endpoint"], metric_data["endpoint"])
-        self.assertEqual(retrieved_metrics[0]["metric_type"], metric_data["metric_type"])
-        self.assertEqual(retrieved_metrics[0]["value"], metric_data["value"])
-
-    def test_store_and_retrieve_strategy_config(self):
-        """Teste le stockage et la récupération de la configuration de stratégie"""
-        # Données de test
-        strategy_name = "RSI_Strategy"
-        config_data = {
-            "rsi_period": 14,
-            "overbought": 70,
-            "oversold": 30
-        }
-        
-        # Stockage de la configuration
-        self.mongodb_manager.store_strategy_config(strategy_name, config_data)
-        
-        # Récupération de la configuration
-        retrieved_config = self.mongodb_manager.get_strategy_config(strategy_name)
-        
-        # Vérifications
-        self.assertIsNotNone(retrieved_config)
-        self.assertEqual(retrieved_config["strategy_name"], strategy_name)
-        self.assertEqual(retrieved_config["config"], config_data)
+        self.assertEqual(_restrict(retrieved_metrics, expected), [expected])
 
     def test_bulk_operations(self):
         """Teste les opérations en masse"""
         data = {
             "symbol": "BTCUSDT",
-            "timestamp": datetime.now(tz.utc),
+            "timestamp": self.now,
             "data": {
                 "ticker": {
                     "price": 50000.0
@@ -196,11 +364,28 @@ class TestMongoDBManager(unittest.TestCase):
         # Test du stockage en masse des indicateurs
         self.mongodb_manager.store_indicators_bulk(indicators_list)
         
-        # Vérification des données stockées
+        # Vérification des données stockées, en une seule requête pour tous les symboles
+        latest = self.mongodb_manager.get_latest_indicators_multi(
+            [data["symbol"] for data in indicators_list]
+        )
+        self.assertEqual(len(latest), len(indicators_list))
         for data in indicators_list:
-            retrieved_data = self.mongodb_manager.get_latest_indicators(data["symbol"], limit=1)
-            self.assertEqual(len(retrieved_data), 1)
-            self.assertEqual(retrieved_data[0]["indicators"], data["indicators"])
+            self.assertEqual(latest[data["symbol"]]["indicators"], data["indicators"])
+
+    def test_store_strategy_configs_bulk(self):
+        """Teste le stockage en masse des configurations de stratégies"""
+        self.mongodb_manager.store_strategy_config("RSI_Strategy", {"rsi_period": 14})
+        configs = {
+            "RSI_Strategy": {"rsi_period": 21},
+            "MACD_Strategy": {"fast": 12, "slow": 26}
+        }
+        self.mongodb_manager.store_strategy_configs_bulk(configs)
+
+        # Vérifications
+        self.assertEqual(self.mongodb_manager.strategy_config.count_documents({}), 2)
+        for strategy_name, config in configs.items():
+            retrieved_config = self.mongodb_manager.get_strategy_config(strategy_name)
+            self.assertEqual(retrieved_config["config"], config)
 
     def test_cleanup_old_data(self):
         """Teste le nettoyage des anciennes données"""
@@ -208,7 +393,7 @@ class TestMongoDBManager(unittest.TestCase):
         # Insérer des données
         data = {
             "symbol": symbol,
-            "timestamp": datetime.now(tz.utc),
+            "timestamp": self.now,
             "data": {
                 "ticker": {
                     "price": 50000.0
@@ -225,19 +410,21 @@ class TestMongoDBManager(unittest.TestCase):
         # Nettoyage des données
         self.mongodb_manager.cleanup_old_data(days_to_keep=0)
         
-        # Attendre un peu pour s'assurer que les données sont supprimées
-        time.sleep(0.5)
-        
-        # Vérification que les données ont été supprimées
-        retrieved_market_data = self.mongodb_manager.get_latest_market_data(symbol)
-        self.assertIsNone(retrieved_market_data)
-        
-        start_time = datetime.now(tz.utc) - timedelta(minutes=1)
-        retrieved_monitoring = self.mongodb_manager.get_monitoring_data(start_time)
-        self.assertEqual(len(retrieved_monitoring), 0)
-        
-        retrieved_metrics = self.mongodb_manager.get_api_metrics(endpoint="test")
-        self.assertEqual(len(retrieved_metrics), 0)
+        # Vérification que les données ont été supprimées, en une seule agrégation (MongoDB 4.4+)
+        start_time = self.now - timedelta(minutes=1)
+        remaining = list(self.mongodb_manager.market_data.aggregate([
+            {"$match": {"symbol": symbol}},
+            {"$unionWith": {
+                "coll": self.mongodb_manager.monitoring.name,
+                "pipeline": [{"$match": {"timestamp": {"$gte": start_time}}}]
+            }},
+            {"$unionWith": {
+                "coll": self.mongodb_manager.api_metrics.name,
+                "pipeline": [{"$match": {"endpoint": "test"}}]
+            }},
+            {"$count": "remaining"}
+        ]))
+        self.assertEqual(remaining, [])
 
     def test_get_latest_market_data(self):
         """Test de récupération des dernières données de marché"""
@@ -245,7 +432,7 @@ class TestMongoDBManager(unittest.TestCase):
         symbol = "BTCUSDT"
         data = {
             "symbol": symbol,
-            "timestamp": datetime.now(tz.utc),
+            "timestamp": self.now,
             "data": {
                 "ticker": {
                     "price": 50000.0
@@ -268,24 +455,22 @@ class TestMongoDBManager(unittest.TestCase):
         symbol = "BTCUSDT"
         test_data = {
             "symbol": symbol,
-            "timestamp": datetime.now(tz.utc),
+            "timestamp": self.now,
             "rsi": 65.5
         }
         self.mongodb_manager.indicators.insert_one(test_data)
         
-        result = self.mongodb_manager.get_latest_indicators(symbol)
-        self.assertIsInstance(result, list)
-        self.assertEqual(len(result), 1)
-        self.assertEqual(result[0]["symbol"], symbol)
-        self.assertEqual(result[0]["rsi"], 65.5)
+        result = self.mongodb_manager.get_latest_indicators(symbol, fields=["symbol", "rsi"])
+        expected = {"symbol": symbol, "rsi": 65.5}
+        self.assertEqual(_restrict(result, expected), [expected])
 
     def test_get_trades_by_timeframe(self):
         """Test de récupération des transactions par période"""
-        start_time = datetime.now(tz.utc) - timedelta(hours=1)
-        end_time = datetime.now(tz.utc)
+        start_time = self.now - timedelta(hours=1)
+        end_time = self.now
         test_trade = {
             "symbol": "BTCUSDT",
-            "timestamp": datetime.now(tz.utc) - timedelta(minutes=30),
+            "timestamp": self.now - timedelta(minutes=30),
             "price": 50000.0,
             "quantity": 1.0
         }
@@ -305,12 +490,11 @@ class TestMongoDBManager(unittest.TestCase):
         }
         self.mongodb_manager.store_monitoring_data(test_data)
         
-        start_time = datetime.now(tz.utc) - timedelta(minutes=5)
-        end_time = datetime.now(tz.utc)
+        now = datetime.now(tz.utc)
+        start_time = now - timedelta(minutes=5)
+        end_time = now
+        self.assertTrue(self.mongodb_manager.has_monitoring_since(start_time))
         result = self.mongodb_manager.get_monitoring_data(start_time, end_time)
-        
-        self.assertIsInstance(result, list)
-        self.assertTrue(len(result) > 0)
         self.assertEqual(result[0]["event_type"], "API_CALL")
         self.assertEqual(result[0]["endpoint"], "/api/v3/ticker")
 
@@ -334,5 +518,14 @@ class TestMongoDBManager(unittest.TestCase):
         self.assertEqual(result[0]["metric_type"], "response_time")
         self.assertEqual(result[0]["value"], 200)
 
+    def test_symbol_timestamp_indexes(self):
+        """Vérifie l'index (symbol, timestamp desc) utilisé par les requêtes get_latest_*"""
+        expected_key = [("symbol", 1), ("timestamp", -1)]
+        for collection in (self.mongodb_manager.market_data,
+                           self.mongodb_manager.indicators,
+                           self.mongodb_manager.trades):
+            index_keys = [list(index["key"]) for index in collection.index_information().values()]
+            self.assertIn(expected_key, index_keys)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
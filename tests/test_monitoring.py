@@ -1,50 +1,84 @@
-import pytest
-import time
+import copy
+import json
 import os
-from unittest.mock import patch, Mock, MagicMock
+import threading
+import pytest
+from time import perf_counter
+from unittest.mock import patch, Mock
 from dotenv import load_dotenv
-from src.monitoring.api_monitor import APIMonitor
+from pybit.unified_trading import HTTP
+from src.monitoring.api_monitor import AlertThresholds, APIMonitor
+
+# Attributs du client Bybit mocké, introspectés une seule fois
+_HTTP_SPEC = dir(HTTP)
+
+# Réponses de l'API partagées par les tests (jamais modifiées par l'APIMonitor)
+_TICKER_RESPONSE = {
+    "retCode": 0,
+    "result": {
+        "symbol": "BTCUSDT",
+        "price": "50000",
+        "time": 1704110400000  # Horodatage fixe : le moniteur ne le lit pas
+    }
+}
+_WALLET_RESPONSE = {
+    "retCode": 0,
+    "result": {
+        "list": [
+            {
+                "totalEquity": "1000",
+                "accountType": "UNIFIED",
+                "totalWalletBalance": "1000",
+                "accountIMRate": "0.1",
+                "totalMarginBalance": "1000"
+            }
+        ]
+    }
+}
 
 # Fixtures communs
 @pytest.fixture
 def mock_response():
-    """Fixture pour créer une réponse mock"""
-    return {
-        "retCode": 0,
-        "result": {
-            "symbol": "BTCUSDT",
-            "price": "50000",
-            "time": int(time.time() * 1000)
-        }
-    }
+    """Fixture pour la réponse mock du ticker"""
+    return _TICKER_RESPONSE
 
 @pytest.fixture
 def mock_wallet_response():
     """Fixture pour la réponse du wallet"""
-    return {
-        "retCode": 0,
-        "result": {
-            "list": [
-                {
-                    "totalEquity": "1000",
-                    "accountType": "UNIFIED",
-                    "totalWalletBalance": "1000",
-                    "accountIMRate": "0.1",
-                    "totalMarginBalance": "1000"
-                }
-            ]
-        }
-    }
+    return _WALLET_RESPONSE
 
 @pytest.fixture
-def monitor():
-    """Fixture pour créer une instance du moniteur"""
+def mock_client(mock_response, mock_wallet_response):
+    """Fixture pour le mock du client Bybit, configuré pour le cas nominal"""
+    mock_client = Mock(spec_set=_HTTP_SPEC)
+    mock_client.configure_mock(**{
+        'get_tickers.return_value': mock_response,
+        'get_wallet_balance.return_value': mock_wallet_response
+    })
+    return mock_client
+
+@pytest.fixture(scope="module")
+def shared_monitor(tmp_path_factory):
+    """Fixture pour construire une seule fois le moniteur du module"""
     load_dotenv()
-    monitor = APIMonitor(testnet=True)
+    # Répertoire de logs propre au module : pas de collision entre workers pytest-xdist
+    return APIMonitor(log_dir=str(tmp_path_factory.mktemp("monitor_logs")), testnet=True)
+
+@pytest.fixture
+def monitor(shared_monitor, mock_client):
+    """Fixture pour réinitialiser le moniteur partagé et y brancher le client mocké"""
+    monitor = shared_monitor
+    monitor.client = mock_client
     monitor.total_requests = 0
     monitor.failed_requests = 0
-    monitor.metrics = []
-    return monitor
+    monitor.consecutive_failures = 0
+    monitor.reset_metrics()
+    monitor.stop_event.clear()
+
+    # Les tests d'alertes modifient les seuils : restauration après le test
+    alert_thresholds = copy.copy(monitor.alert_thresholds)
+    yield monitor
+    monitor.alert_thresholds = alert_thresholds
 
 class TestAPIMonitor:
     """Tests pour le monitoring de l'API"""
@@ -55,9 +89,19 @@ class TestAPIMonitor:
         assert monitor.testnet is True
         assert monitor.total_requests == 0
         assert monitor.failed_requests == 0
-        assert isinstance(monitor.alert_thresholds, dict)
+        assert isinstance(monitor.alert_thresholds, AlertThresholds)
         assert monitor.consecutive_failures == 0
 
+    def test_alert_thresholds_item_access(self, monitor):
+        """Test de l'accès par clé aux seuils d'alerte"""
+        monitor.alert_thresholds['latency'] = 100
+        assert monitor.alert_thresholds.latency == 100
+        assert monitor.alert_thresholds['latency'] == 100
+        with pytest.raises(KeyError):
+            monitor.alert_thresholds['unknown'] = 1
+        with pytest.raises(KeyError):
+            monitor.alert_thresholds['__init__']
+
     def test_is_valid_response(self, monitor, mock_response):
         """Test de la validation des réponses"""
         assert monitor.is_valid_response(mock_response) is True
@@ -65,41 +109,37 @@ class TestAPIMonitor:
         assert monitor.is_valid_response(None) is False
         assert monitor.is_valid_response({}) is False
 
-    def test_measure_latency_success(self, monitor, mock_response):
+    def test_measure_latency_success(self, monitor):
         """Test de la mesure de latence avec succès"""
-        with patch('time.time', side_effect=[1000, 1000.5]), \
-             patch.object(monitor.client, 'get_tickers', return_value=mock_response):
-            
+        with patch('src.monitoring.api_monitor._pc', side_effect=[1000, 1000.5]):
             latency = monitor.measure_latency("/v5/market/tickers", "get_ticker")
             assert isinstance(latency, float)
             assert latency == 500.0  # 500ms
             assert monitor.consecutive_failures == 0
-            assert len([m for m in monitor.metrics if m['type'] == 'latency']) == 1
+            assert monitor.metric_counts['latency'] == 1
 
     def test_measure_latency_failure(self, monitor):
         """Test de la mesure de latence avec échec"""
-        with patch('time.time', side_effect=[1000, 1000.5, 1000.5, 1000.5]), \
-             patch.object(monitor.client, 'get_tickers', return_value={"retCode": 1}):
-            
+        monitor.client.get_tickers.return_value = {"retCode": 1}
+        with patch('src.monitoring.api_monitor._pc', side_effect=[1000, 1000.5]):
             latency = monitor.measure_latency("/v5/market/tickers", "get_ticker")
             assert latency is None
             assert monitor.consecutive_failures == 1
-            assert len([m for m in monitor.metrics if m['type'] == 'error']) == 1
+            assert monitor.metric_counts['error'] == 1
 
-    def test_check_availability(self, monitor, mock_response):
+    def test_check_availability(self, monitor):
         """Test de la vérification de disponibilité"""
-        with patch.object(monitor.client, 'get_tickers', return_value=mock_response):
-            assert monitor.check_availability() is True
-            assert len([m for m in monitor.metrics if m['type'] == 'availability']) == 1
+        assert monitor.check_availability() is True
+        assert monitor.metric_counts['availability'] == 1
 
-    def test_check_rate_limits(self, monitor, mock_wallet_response):
+    def test_check_rate_limits(self, monitor):
         """Test de la vérification des limites de taux"""
-        with patch.object(monitor.client, 'get_wallet_balance', return_value=mock_wallet_response):
-            result = monitor.check_rate_limits()
-            assert isinstance(result, dict)
-            assert 'status' in result
-            assert 'usage_percent' in result
-            assert len([m for m in monitor.metrics if m['type'] == 'rate_limit']) == 1
+        result = monitor.check_rate_limits()
+        assert isinstance(result, dict)
+        assert 'status' in result
+        assert 'usage_percent' in result
+        assert monitor.metric_counts['rate_limit'] == 1
+        monitor.client.get_wallet_balance.assert_called_once_with(accountType="UNIFIED")
 
     def test_record_metric(self, monitor):
         """Test de l'enregistrement des métriques"""
@@ -111,34 +151,65 @@ class TestAPIMonitor:
         assert metric['endpoint'] == '/test'
         assert metric['exchange'] == 'bybit'
         assert metric['testnet'] is True
+        assert metric.to_dict()['type'] == 'test'
+        with pytest.raises(KeyError):
+            metric['to_dict']
 
-    def test_get_alerts_latency(self, monitor):
-        """Test des alertes de latence"""
-        monitor.alert_thresholds['latency'] = 100
-        monitor.record_metric('latency', 200.0, '/test')
-        alerts = monitor.get_alerts()
-        assert len(alerts) == 1
-        assert alerts[0]['type'] == 'latency'
-        assert alerts[0]['value'] == 200.0
-
-    def test_get_alerts_error_rate(self, monitor):
-        """Test des alertes de taux d'erreur"""
-        monitor.alert_thresholds['error_rate'] = 0.1
-        monitor.total_requests = 10
-        monitor.failed_requests = 2
-        alerts = monitor.get_alerts()
-        assert len(alerts) == 1
-        assert alerts[0]['type'] == 'error_rate'
-        assert alerts[0]['value'] == 0.2
+    def test_save_metrics(self, monitor):
+        """Test de la sauvegarde des métriques au format JSON"""
+        monitor.record_metric('latency', 100.0, '/test')
+        monitor.record_metric('availability', 1, '/test')
+        with open(os.path.join(monitor.log_dir, 'metrics.json')) as f:
+            saved = f.read()
+        assert saved == json.dumps([metric.to_dict() for metric in monitor.metrics])
+
+    def test_metrics_window_is_bounded(self, tmp_path):
+        """Test de l'éviction des métriques les plus anciennes"""
+        monitor = APIMonitor(log_dir=str(tmp_path), testnet=True, max_metrics=2)
+        for value in (1.0, 2.0, 3.0):
+            monitor.record_metric('test', value, '/test')
+        assert [m['value'] for m in monitor.metrics] == [2.0, 3.0]
+
+    def test_invalid_max_metrics(self, tmp_path):
+        """Test du refus d'une fenêtre de métriques vide"""
+        with pytest.raises(ValueError):
+            APIMonitor(log_dir=str(tmp_path), testnet=True, max_metrics=0)
+
+    def test_latency_stats_follow_window(self, tmp_path):
+        """Test des statistiques de latence après éviction des métriques les plus anciennes"""
+        monitor = APIMonitor(log_dir=str(tmp_path), testnet=True, max_metrics=3)
+        for value in (500.0, 100.0, 300.0, 200.0):
+            monitor.record_metric('latency', value, '/test')
+        monitor.record_metric('availability', 1, '/test')
+
+        # Fenêtre restante : latences 300.0 et 200.0, puis la disponibilité
+        summary = monitor.get_metrics_summary()
+        assert summary['avg_latency'] == 250.0
+        assert summary['min_latency'] == 200.0
+        assert summary['max_latency'] == 300.0
+        assert monitor.metric_counts['latency'] == 2
+        assert sum(monitor.metric_counts.values()) == len(monitor.metrics)
+
+    @pytest.mark.parametrize("alert_type, threshold, state, metric_values, expected_value", [
+        # Latence moyenne au-dessus du seuil
+        ("latency", 100, {}, [200.0], 200.0),
+        # Taux d'erreur au-dessus du seuil
+        ("error_rate", 0.1, {"total_requests": 10, "failed_requests": 2}, [], 0.2),
+        # Échecs consécutifs au-delà du seuil
+        ("consecutive_failures", 3, {"consecutive_failures": 4}, [], 4),
+    ], ids=["latency", "error_rate", "consecutive_failures"])
+    def test_get_alerts(self, monitor, alert_type, threshold, state, metric_values, expected_value):
+        """Test des alertes de latence, de taux d'erreur et d'échecs consécutifs"""
+        monitor.alert_thresholds[alert_type] = threshold
+        for name, value in state.items():
+            setattr(monitor, name, value)
+        for value in metric_values:
+            monitor.record_metric(alert_type, value, '/test')
 
-    def test_get_alerts_consecutive_failures(self, monitor):
-        """Test des alertes d'échecs consécutifs"""
-        monitor.alert_thresholds['consecutive_failures'] = 3
-        monitor.consecutive_failures = 4
         alerts = monitor.get_alerts()
         assert len(alerts) == 1
-        assert alerts[0]['type'] == 'consecutive_failures'
-        assert alerts[0]['value'] == 4
+        assert alerts[0]['type'] == alert_type
+        assert alerts[0]['value'] == expected_value
 
     def test_get_metrics_summary(self, monitor):
         """Test du résumé des métriques"""
@@ -156,13 +227,38 @@ class TestAPIMonitor:
         assert summary['min_latency'] == 100.0
         assert summary['max_latency'] == 200.0
 
+    def test_run_stops_during_error_pause(self, monitor):
+        """Test de l'arrêt de la boucle pendant la pause qui suit une erreur"""
+        failed = threading.Event()
+
+        def _fail():
+            failed.set()
+            raise Exception("Test error")
+
+        def _stop_after_failure():
+            failed.wait(timeout=2)
+            monitor.stop_event.set()
+
+        # Arrêt demandé depuis un autre thread, pendant la pause de 5s
+        stopper = threading.Thread(target=_stop_after_failure)
+        with patch.object(monitor, 'check_api_status', side_effect=_fail) as check_api_status:
+            stopper.start()
+            start = perf_counter()
+            monitor.run()
+            elapsed = perf_counter() - start
+        stopper.join()
+
+        assert check_api_status.call_count == 1
+        assert elapsed < 1  # Bien avant la fin de la pause
+
     def test_error_handling(self, monitor):
         """Test de la gestion des erreurs"""
-        with patch.object(monitor.client, 'get_tickers', side_effect=Exception("Test error")):
-            result = monitor.check_availability()
-            assert result is False
-            assert monitor.consecutive_failures == 1
-            assert len([m for m in monitor.metrics if m['type'] == 'availability' and m['value'] == 0]) == 1
+        monitor.client.get_tickers.side_effect = Exception("Test error")
+        result = monitor.check_availability()
+        assert result is False
+        assert monitor.consecutive_failures == 1
+        assert monitor.metric_counts['availability'] == 1
+        assert monitor.metrics[-1]['value'] == 0
 
 if __name__ == "__main__":
     pytest.main(["-v", __file__])